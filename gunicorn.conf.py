@@ -0,0 +1,8 @@
+import multiprocessing
+
+# Prometheus queries are I/O-bound, so each worker serves many requests concurrently as greenlets.
+# Rendering graphs is CPU-bound and blocks its worker, so run one worker per CPU.
+bind = '0.0.0.0:5000'
+worker_class = 'gevent'
+workers = multiprocessing.cpu_count()
+worker_connections = 512
@@ -1,65 +1,218 @@
-import math
-import statistics
+import numpy as np
+import orjson
 from flask import Flask, Response, request, jsonify
-import matplotlib.pyplot as plt
-from prometheus_api_client import PrometheusConnect  # type: ignore
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+import matplotlib.dates as mdates
+from matplotlib import font_manager
 from io import BytesIO
 import logging
 from datetime import datetime, timedelta, timezone
 import re
-from PIL import Image
+from functools import lru_cache
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from cachetools import TTLCache
 
 app = Flask(__name__)
 
 # Setup logging
 logging.basicConfig(level=logging.DEBUG)
 
+# Fix the matplotlib font configuration once at import: a single bundled font and no LaTeX
+matplotlib.rcParams.update({
+    'text.usetex': False,
+    'font.family': 'DejaVu Sans',
+})
+
+# Resolve the font up front so the first request doesn't pay for the font lookup
+font_manager.findfont(matplotlib.rcParams['font.family'][0])
+
+# One pooled HTTP session per Prometheus server
+_prom_sessions: dict[str, requests.Session] = {}
+_prom_sessions_lock = threading.Lock()
+
+# Rendered /graph PNGs keyed by request parameters and aligned time range
+_graph_cache: TTLCache[tuple, bytes] = TTLCache(maxsize=256, ttl=60)
+_graph_cache_lock = threading.Lock()
+
+# Raw Prometheus results keyed by (server, query, aligned start, aligned end, step), shared by /graph and /stats
+_query_cache: TTLCache[tuple[str, str, datetime, datetime, str], list[dict]] = TTLCache(maxsize=1024, ttl=30)
+_query_cache_lock = threading.Lock()
+
+# Relative time strings like '2min' and the timedelta constructor for each unit
+_TIME_PATTERN = re.compile(r'(\d+)([a-zA-Z]+)')
+_TIME_UNITS = {
+    'sec': lambda amount: timedelta(seconds=amount),
+    'min': lambda amount: timedelta(minutes=amount),
+    'h': lambda amount: timedelta(hours=amount),
+    'day': lambda amount: timedelta(days=amount),
+    'year': lambda amount: timedelta(days=amount * 365),
+}
+
+@lru_cache(maxsize=512)
 def parse_time(value):
     """Parse a time string like '2min', '3sec', '5day', '1year' into a timedelta object."""
-    pattern = r'(\d+)([a-zA-Z]+)'
-    match = re.match(pattern, value)
+    match = _TIME_PATTERN.match(value)
     if not match:
         raise ValueError(f"Invalid time format: {value}")
 
     amount, unit = int(match.group(1)), match.group(2)
 
-    if unit == 'sec':
-        return timedelta(seconds=amount)
-    elif unit == 'min':
-        return timedelta(minutes=amount)
-    elif unit == 'h':
-        return timedelta(hours=amount)
-    elif unit == 'day':
-        return timedelta(days=amount)
-    elif unit == 'year':
-        return timedelta(days=amount * 365)
-    else:
+    if unit not in _TIME_UNITS:
         raise ValueError(f"Unsupported time unit: {unit}")
+    return _TIME_UNITS[unit](amount)
+
+@lru_cache(maxsize=512)
+def parse_absolute_time(value):
+    """Parse an ISO 8601 time string into a datetime object, assuming UTC if no timezone is given."""
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+def is_relative_time(value):
+    """Return whether a time input is 'now' or a relative time like '2min', i.e. depends on the current time."""
+    if value == 'now':
+        return True
+    match = _TIME_PATTERN.fullmatch(value)
+    return bool(match) and match.group(2) in _TIME_UNITS
 
 def parse_time_input(value):
     """Parse input time string into a datetime object."""
     if value == 'now':
         return datetime.now(timezone.utc)
-    else:
-        # Try to parse as an absolute time
-        try:
-            dt = datetime.fromisoformat(value)
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
-            return dt
-        except ValueError:
-            # Try to parse as a relative time
-            try:
-                delta = parse_time(value)
-                return datetime.now(timezone.utc) - delta
-            except ValueError:
-                raise ValueError(f"Invalid time format: {value}")
+
+    # Relative times like '2min' are recognized up front, everything else is parsed as an absolute time
+    if is_relative_time(value):
+        return datetime.now(timezone.utc) - parse_time(value)
+    try:
+        return parse_absolute_time(value)
+    except ValueError:
+        raise ValueError(f"Invalid time format: {value}")
+
+def parse_series(series):
+    """Split a series' (n, 2) sample array into its timestamp and value columns."""
+    raw = series['values']
+    return raw[:, 0], raw[:, 1]
 
 def calculate_step(start_time, end_time, desired_points=100):
     total_seconds = (end_time - start_time).total_seconds()
     step_seconds = max(total_seconds / desired_points, 2)  # Minimum step of 2s
     return f'{int(step_seconds)}s'
 
+def align_time_range(start_time, end_time, step, start_time_input, end_time_input):
+    """Round 'now' and relative times down to a multiple of the step, so repeated queries share cache keys.
+
+    Absolute times are left as given.
+    """
+    step_seconds = int(step.rstrip('s'))
+
+    def align(dt, value):
+        if not is_relative_time(value):
+            return dt
+        return datetime.fromtimestamp(int(dt.timestamp()) // step_seconds * step_seconds, tz=timezone.utc)
+
+    aligned_start, aligned_end = align(start_time, start_time_input), align(end_time, end_time_input)
+    # Flooring 'now' can push the end before an absolute start less than a step earlier; keep the exact end then
+    if aligned_end < aligned_start:
+        aligned_end = end_time
+    return aligned_start, aligned_end
+
+class PrometheusQueryError(Exception):
+    """Raised when Prometheus rejects a query or returns an unexpected response."""
+
+def get_session(url):
+    """Return a cached HTTP session for the given Prometheus server, reusing its keep-alive connections."""
+    with _prom_sessions_lock:
+        session = _prom_sessions.get(url)
+        if session is None:
+            session = requests.Session()
+            session.verify = False
+            adapter = HTTPAdapter(pool_connections=50, pool_maxsize=50, max_retries=3)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _prom_sessions[url] = session
+        return session
+
+def query_range(server, query, start_time, end_time, step):
+    """Run a range query against the Prometheus HTTP API and return its series.
+
+    Each series' 'values' are returned as a float64 array of shape (n, 2) holding timestamp and value.
+    """
+    response = get_session(server).post(
+        f"{server.rstrip('/')}/api/v1/query_range",
+        data={'query': query, 'start': start_time.timestamp(), 'end': end_time.timestamp(), 'step': step},
+    )
+    if response.status_code != 200:
+        raise PrometheusQueryError(f"HTTP Status Code {response.status_code} ({response.content!r})")
+
+    body = orjson.loads(response.content)
+    if body.get('status') != 'success':
+        raise PrometheusQueryError(f"Query failed: {body.get('error')}")
+
+    data = body['data']['result']
+    for series in data:
+        series['values'] = np.array(series['values'], dtype=np.float64).reshape(-1, 2)
+    return data
+
+def fetch_combined(server, queries, start_time, end_time, step):
+    """Fetch all queries in a single round-trip by tagging each one with a '__q' label and joining them with 'or'."""
+    combined = ' or '.join(
+        f'label_replace(({query.strip()}), "__q", "{i}", "", "")' for i, query in enumerate(queries)
+    )
+    data = query_range(server, combined, start_time, end_time, step)
+
+    # Split the series back up by the query they belong to
+    results = [[] for _ in queries]
+    for series in data:
+        results[int(series['metric'].pop('__q'))].append(series)
+    return results
+
+def fetch_queries(server, queries, start_time, end_time, step):
+    """Return the results of all range queries in query order, only querying Prometheus for uncached ones."""
+    keys = [(server, query.strip(), start_time, end_time, step) for query in queries]
+    with _query_cache_lock:
+        results = [_query_cache.get(key) for key in keys]
+
+    missing = [i for i, data in enumerate(results) if data is None]
+    if missing:
+        fetched = fetch_uncached_queries(server, [queries[i] for i in missing], start_time, end_time, step)
+        with _query_cache_lock:
+            for i, data in zip(missing, fetched):
+                results[i] = _query_cache[keys[i]] = data
+    return results
+
+def fetch_uncached_queries(server, queries, start_time, end_time, step, max_workers=8):
+    """Run all range queries and return their results in query order.
+
+    Multiple queries are sent as one combined expression. If Prometheus rejects it
+    (e.g. a query evaluates to a scalar), the queries are run concurrently instead.
+    """
+    if len(queries) > 1:
+        try:
+            return fetch_combined(server, queries, start_time, end_time, step)
+        except PrometheusQueryError as e:
+            app.logger.warning(f"Combined query failed, falling back to separate queries: {e}")
+
+    def fetch(query):
+        return query_range(server, query.strip(), start_time, end_time, step)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(queries))) as executor:
+        return list(executor.map(fetch, queries))
+
+def png_response(png):
+    """Return the PNG bytes with an ETag, answering repeated polls of an unchanged graph with 304 Not Modified."""
+    response = Response(png, mimetype='image/png')
+    response.add_etag()
+    return response.make_conditional(request)
+
 @app.route('/')
 def home():
     return "Welcome to the Prometheus Matplotlib Graph Server!"
@@ -91,23 +244,41 @@ def graph():
         if start_time > end_time:
             return jsonify({"error": "Start time must be before end time"}), 400
 
-        prom = PrometheusConnect(url=prometheus_server, disable_ssl=True)
-
         step = calculate_step(start_time, end_time)
+        start_time, end_time = align_time_range(start_time, end_time, step, start_time_input, end_time_input)
+
+        # Serve a previously rendered graph for the same parameters and time range
+        cache_key = (
+            tuple(sorted((k, v) for k, v in request.args.items(multi=True) if k not in ('start', 'end'))),
+            start_time,
+            end_time,
+        )
+        with _graph_cache_lock:
+            cached_png = _graph_cache.get(cache_key)
+        if cached_png is not None:
+            return png_response(cached_png)
 
         # Create the graph with the specified figure size
-        fig, ax = plt.subplots(figsize=(width, height))
+        # Figures are built directly on the Agg canvas, bypassing pyplot's global figure registry
+        fig = Figure(figsize=(width, height))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
 
-        # Loop through each query and plot the results
-        for i, query in enumerate(queries):
-            label_arg = label_args[i] if len(label_args) > i else None
+        # Fetch the data for all queries
+        results = fetch_queries(prometheus_server, queries, start_time, end_time, step)
+
+        # Collect all series as segments of a single LineCollection, each with the next cycle color
+        colors = matplotlib.rcParams['axes.prop_cycle'].by_key()['color']
+        segments = []
+        segment_colors = []
+        legend_handles = []
+
+        # Matplotlib date number of the Unix epoch
+        epoch_num = mdates.date2num(datetime.fromtimestamp(0, tz=timezone.utc))
 
-            data = prom.custom_query_range(
-                query=query.strip(),
-                start_time=start_time,
-                end_time=end_time,
-                step=step
-            )
+        # Loop through each query and collect the results
+        for i, (query, data) in enumerate(zip(queries, results)):
+            label_arg = label_args[i] if len(label_args) > i else None
 
             if not data:
                 app.logger.error(f"No data returned from Prometheus for query: {query}")
@@ -115,8 +286,9 @@ def graph():
 
             # Loop through each series in the data
             for series in data:
-                times = [datetime.fromtimestamp(value[0], tz=timezone.utc) for value in series['values']]
-                values = [float(value[1]) for value in series['values']]
+                timestamps, values = parse_series(series)
+                # Convert Unix seconds straight to matplotlib date numbers (days since its epoch)
+                times = epoch_num + timestamps / 86400
 
                 # Determine the label
                 if label_arg and label_arg in series['metric']:
@@ -133,7 +305,17 @@ def graph():
                     app.logger.warning(f"Insufficient data points for series: {series['metric']}")
                     continue
 
-                ax.plot(times, values, label=label)
+                color = colors[len(segments) % len(colors)]
+                segments.append(np.column_stack((times, values)))
+                segment_colors.append(color)
+                # Proxy artist for the legend, since the LineCollection itself has no per-series labels
+                legend_handles.append(Line2D([], [], color=color, label=label))
+
+        if segments:
+            ax.add_collection(LineCollection(segments, colors=segment_colors,
+                                         linewidths=matplotlib.rcParams['lines.linewidth']))
+            ax.autoscale_view()
+        ax.xaxis_date(tz=timezone.utc)
 
         ax.set(xlabel=xlabel, ylabel=ylabel, title=title)
         ax.grid()
@@ -141,39 +323,21 @@ def graph():
         # Automatically adjust x-axis labels to prevent overlap
         fig.autofmt_xdate(rotation=45)
 
-        # Save the plot without legend
-        graph_output = BytesIO()
-        plt.savefig(graph_output, format='png', bbox_inches='tight')
-        graph_output.seek(0)
-
-        # Now add the legend and save only the legend
-        fig_legend = plt.figure(figsize=(width, 2))
-        ax_legend = fig_legend.add_subplot(111)
-        ax_legend.legend(*ax.get_legend_handles_labels(), loc='center', frameon=True)
-        ax_legend.axis('off')
-
-        legend_output = BytesIO()
-        plt.savefig(legend_output, format='png', bbox_inches='tight')
-        legend_output.seek(0)
-
-        # Combine the graph and the legend
-        graph_img = Image.open(graph_output)
-        legend_img = Image.open(legend_output)
-        combined_img = graph_img
-
-        # Create a new image with a white background
+        # Hang the legend below the axes, tick labels and x label; bbox_inches='tight' grows the image to fit it
         if legend:
-            total_height = graph_img.height + legend_img.height
-            combined_img = Image.new('RGB', (graph_img.width, total_height), "white")
-            combined_img.paste(graph_img, (0, 0))
-            combined_img.paste(legend_img, (int((graph_img.width/2)-(legend_img.width/2)), graph_img.height))
+            axes_bbox = ax.get_tightbbox(fig.canvas.get_renderer()).transformed(fig.transFigure.inverted())
+            fig.legend(handles=legend_handles, loc='upper center',
+                       bbox_to_anchor=((axes_bbox.x0 + axes_bbox.x1) / 2, axes_bbox.y0), frameon=True)
 
-        # Save the combined image to BytesIO
+        # Render graph and legend into a single PNG, trading some size for much faster zlib compression
         combined_output = BytesIO()
-        combined_img.save(combined_output, format='png')
-        combined_output.seek(0)
+        fig.savefig(combined_output, format='png', bbox_inches='tight', pil_kwargs={'compress_level': 1})
+        png = combined_output.getvalue()
 
-        return Response(combined_output, mimetype='image/png')
+        with _graph_cache_lock:
+            _graph_cache[cache_key] = png
+
+        return png_response(png)
     except Exception as e:
         app.logger.error(f"An unexpected error occurred: {e}")
         return jsonify({"error": f"An unexpected error occurred: {e}"}), 500
@@ -185,6 +349,7 @@ def stats():
     start_time_input = request.args.get('start', '1min')
     end_time_input = request.args.get('end', 'now')
     label_arg_string = request.args.get('label')
+    include_mode = request.args.get('mode', 'false').lower() == 'true'
 
     if not query_string:
         return "Please provide a Prometheus query using the 'query' parameter."
@@ -200,24 +365,19 @@ def stats():
         if start_time > end_time:
             return jsonify({"error": "Start time must be before end time"}), 400
 
-        prom = PrometheusConnect(url=prometheus_server, disable_ssl=True)
-
         step = calculate_step(start_time, end_time)
+        start_time, end_time = align_time_range(start_time, end_time, step, start_time_input, end_time_input)
 
         # Initialisiere ein Dictionary, um Werte pro Label zu speichern
         label_data = {}
 
+        # Hole die Daten für alle Abfragen
+        results = fetch_queries(prometheus_server, queries, start_time, end_time, step)
+
         # Schleife durch jede Abfrage
-        for i, query in enumerate(queries):
+        for i, (query, data) in enumerate(zip(queries, results)):
             label_arg = label_args[i] if len(label_args) > i else None
 
-            data = prom.custom_query_range(
-                query=query.strip(),
-                start_time=start_time,
-                end_time=end_time,
-                step=step
-            )
-
             if not data:
                 app.logger.error(f"No data returned from Prometheus for query: {query}")
                 continue
@@ -235,51 +395,49 @@ def stats():
                     else:
                         label = 'Unknown'
 
-                # Hole die Werte
-                values = [float(value[1]) for value in series['values']]
+                # Hole die Werte als float64-Array, ohne NaN-Werte
+                _, values = parse_series(series)
+                values = values[~np.isnan(values)]
 
                 # Füge die Werte zum label_data hinzu
                 if label not in label_data:
                     label_data[label] = []
 
-                label_data[label].extend(values)
+                label_data[label].append(values)
 
 
         # Berechne nun die Statistiken pro Label
         result = {}
-        for label, values in label_data.items():
-            if not values:
-                continue
-
-            # Filtern von NaN-Werten
-            values = [v for v in values if not math.isnan(v)]
+        for label, arrays in label_data.items():
+            # Einmal sortieren, dann stehen Minimum, Maximum und Quartile direkt zur Verfügung
+            values = np.sort(np.concatenate(arrays))
 
             # Überprüfen, ob nach dem Filtern noch Daten vorhanden sind
-            if not values:
+            if not values.size:
                 app.logger.warning(f"No valid data points for label {label} after removing NaN values.")
                 continue
 
             try:
-                mean_value = statistics.mean(values)
-                median_value = statistics.median(values)
-                try:
-                    mode_value = statistics.mode(values)
-                except statistics.StatisticsError:
-                    mode_value = None  # Kein eindeutiger Modus
-                stdev_value = statistics.stdev(values) if len(values) > 1 else 0
-                variance_value = statistics.variance(values) if len(values) > 1 else 0
-                min_value = min(values)
-                max_value = max(values)
-                count = len(values)
-                sum_value = sum(values)
+                mean_value = float(np.mean(values))
+                stdev_value = float(np.std(values, ddof=1)) if values.size > 1 else 0
+                variance_value = float(np.var(values, ddof=1)) if values.size > 1 else 0
+                min_value = float(values[0])
+                max_value = float(values[-1])
+                count = int(values.size)
+                sum_value = float(np.sum(values))
                 range_value = max_value - min_value
-                avg_deviation = statistics.mean([abs(x - mean_value) for x in values])
+                avg_deviation = float(np.mean(np.abs(values - mean_value)))
                 # Berechne die Quartile
-                quartiles = statistics.quantiles(values, n=4, method='inclusive')
-                percentile_25 = quartiles[0]
-                percentile_50 = quartiles[1]
-                percentile_75 = quartiles[2]
+                percentile_25, percentile_50, percentile_75 = (
+                    float(p) for p in np.percentile(values, [25, 50, 75]))
+                median_value = percentile_50
                 iqr = percentile_75 - percentile_25  # Interquartilsabstand
+                # Modus nur auf Anfrage; auf den sortierten Werten sind gleiche Werte zusammenhängende Läufe
+                if include_mode:
+                    run_starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+                    run_lengths = np.diff(np.r_[run_starts, values.size])
+                    # Kein Modus, wenn kein Wert mehrfach vorkommt
+                    mode_value = float(values[run_starts[run_lengths.argmax()]]) if run_lengths.max() > 1 else None
             except Exception as e:
                 app.logger.error(f"Error computing statistics for label {label}: {e}")
                 continue
@@ -287,7 +445,6 @@ def stats():
             result[label] = {
                 'mean': mean_value,
                 'median': median_value,
-                'mode': mode_value,
                 'stdev': stdev_value,
                 'variance': variance_value,
                 'min': min_value,
@@ -301,8 +458,10 @@ def stats():
                 'percentile_75': percentile_75,
                 'iqr': iqr
             }
+            if include_mode:
+                result[label]['mode'] = mode_value
 
-        return jsonify(result)
+        return Response(orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY), mimetype='application/json')
 
     except Exception as e:
         app.logger.error(f"An unexpected error occurred: {e}")
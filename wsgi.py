@@ -0,0 +1,5 @@
+# Patch the standard library for gevent before anything imports socket, ssl or requests
+from gevent import monkey  # type: ignore
+monkey.patch_all()
+
+from main import app  # noqa: E402